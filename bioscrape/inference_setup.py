@@ -449,7 +449,7 @@ class InferenceSetup(object):
             # You can use self.other_data array here.
             print('I am about to set my pid_interface')
             self.pid_interface = InterprelatorInference(self.params_to_estimate, self.M, self.prior, **kwargs)
-            self.pid_interface.setup_likelihood_function(self.LL_data, self.timepoints, self.measurements, self.other_data, self.other_columns
+            self.pid_interface.setup_likelihood_function(self.LL_data, self.timepoints, self.measurements, self.other_data, self.other_columns,
                                                          initial_conditions=self.initial_conditions,
                                                          parameter_conditions=self.parameter_conditions,
                                                          norm_order=self.norm_order, **kwargs)
@@ -4,8 +4,14 @@ from bioscrape.inference import StochasticTrajectoriesLikelihood as STLL
 from bioscrape.inference import StochasticTrajectories
 from bioscrape.inference import BulkData
 from bioscrape.simulator import py_simulate_model
+from bioscrape.random import py_seed_random, py_rand_int
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from collections import OrderedDict
 import matplotlib.pyplot as plt
 import warnings
+import math
+import os
 import numpy as np
 
 ## Generate a new PIDINterface subclass copied from DeterministicInference, replace DLL function is core change, then generate new get log likelihood from prior + likelihood functions in this notebook
@@ -14,6 +20,80 @@ import numpy as np
 # in terminal to recompile before testing changes + restart notebook
 # I need to either input paramters instead of initial values or have a step that converts them into parameters if I want to sample off that
 
+# Up to this many parameters, the prior check is generated as unrolled Python code for the
+# parameters to estimate, which is faster than NumPy, whose per-operation overhead dominates
+# on small arrays
+_UNROLL_MAX_PARAMS = 64
+
+# Log normalization constant of the normal distribution
+_LOG_2PI_HALF = 0.5*math.log(2*math.pi)
+
+# Minimum length of the prior list (including the prior name) of each built-in prior
+_PRIOR_LENGTHS = {'uniform': 3, 'gaussian': 3, 'exponential': 2, 'gamma': 3,
+                  'log-uniform': 3, 'log-gaussian': 3, 'beta': 3, 'log10_isNorm': 3,
+                  'neg_binom': 3, 'custom': 2}
+
+def _generate_function(source):
+    '''
+    Execute the source code of a single function definition and return the function.
+    '''
+    namespace = {'inf': np.inf}
+    exec(compile(source, '<pid_interfaces generated>', 'exec'), namespace)
+    return namespace['_generated']
+
+def _params_dict_source(param_keys):
+    '''
+    Source of a function filling a dictionary with the parameter values, e.g. for ['k1', 'd1']:
+        def _generated(p, params_dict):
+            params_dict['k1'], params_dict['d1'] = p.tolist()
+            return params_dict
+    '''
+    lines = ['def _generated(p, params_dict):']
+    if param_keys:
+        targets = ', '.join('params_dict[{0!r}]'.format(key) for key in param_keys)
+        lines.append('    {0}, = p.tolist()'.format(targets))
+    lines.append('    return params_dict')
+    return '\n'.join(lines) + '\n'
+
+def _prior_check_source(lower, upper, mu, inv_sigma, max_half_sq):
+    '''
+    Source of an unrolled version of PIDInterface._check_prior_numpy for fixed prior arrays.
+    Only the finite bounds and the gaussian priors produce code, e.g. for a uniform prior 
+    on [0, 10] followed by a gaussian prior with mean 1 and standard deviation 2:
+        def _generated(p):
+            p0, p1, = p.tolist()
+            if p0 < 0.0 or p0 > 10.0: return inf
+            d1 = (p1 - 1.0)*0.5
+            h1 = 0.5*d1*d1
+            return -(h1)
+    '''
+    n_params = len(lower)
+    lines = ['def _generated(p):']
+    if n_params:
+        lines.append('    {0}, = p.tolist()'.format(', '.join('p{0}'.format(i) for i in range(n_params))))
+    for i in range(n_params):
+        conditions = []
+        if np.isfinite(lower[i]):
+            conditions.append('p{0} < {1!r}'.format(i, float(lower[i])))
+        if np.isfinite(upper[i]):
+            conditions.append('p{0} > {1!r}'.format(i, float(upper[i])))
+        if conditions:
+            lines.append('    if {0}: return inf'.format(' or '.join(conditions)))
+    half_squares = []
+    for i in range(n_params):
+        if inv_sigma[i] == 0:
+            continue
+        lines.append('    d{0} = (p{0} - {1!r})*{2!r}'.format(i, float(mu[i]), float(inv_sigma[i])))
+        lines.append('    h{0} = 0.5*d{0}*d{0}'.format(i))
+        if np.isfinite(max_half_sq[i]):
+            lines.append('    if h{0} > {1!r}: return inf'.format(i, float(max_half_sq[i])))
+        half_squares.append('h{0}'.format(i))
+    if half_squares:
+        lines.append('    return -({0})'.format(' + '.join(half_squares)))
+    else:
+        lines.append('    return 0.0')
+    return '\n'.join(lines) + '\n'
+
 class PIDInterface():
     '''
     PID Interface : Parameter identification interface.
@@ -46,46 +126,262 @@ class PIDInterface():
         self.default_parameters = dict(M.get_parameter_dictionary())
         self.log_space_parameters = kwargs.get('log_space_parameters', False)
         self.debug = kwargs.get('debug', False)
+        # Likelihood memoization, disabled by default because rounding the parameters is lossy
+        self.cache_decimals = kwargs.get('cache_decimals', None)
+        self.cache_size = kwargs.get('cache_size', 1024)
+        self._likelihood_cache = OrderedDict()
+        # Lazily filled with (mu, 1/sigma, log normalization, log threshold) per parameter
+        self._gaussian_cache = {}
+        self._param_keys = tuple(params_to_estimate)
+        self._params_dict = {key: 0.0 for key in self._param_keys}
+        self._setup_prior_functions()
+        self._setup_prior_arrays()
+        self._setup_specialized_functions()
         return
-    
-    ### This is a function I will edit, implementing sampled arrays should be reasonable
-    def check_prior(self, params_dict):
+
+    def __getstate__(self):
         '''
-        To add new prior functions: simply add a new function similar to ones that exist and then 
-        call it here.
+        The generated functions can not be pickled, they are generated again by __setstate__.
         '''
-        lp = 0.0
-        for key,value in params_dict.items():
-            if 'positive' in self.prior[key] and value  < 0:
-                return np.inf
-            prior_type = self.prior[key][0]
+        state = self.__dict__.copy()
+        state['_fill_params_dict'] = None
+        state['_prior_check'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._setup_specialized_functions()
+
+    def _setup_specialized_functions(self):
+        '''
+        Generate functions specialized to this set of parameters, with the parameter names 
+        and prior constants written into their code:
+        * `_fill_params_dict(params_values, params_dict)` fills params_dict from params_values
+        * `_prior_check(params_values)` is an unrolled version of the uniform and gaussian prior
+          checks of check_prior_vec, only generated for up to _UNROLL_MAX_PARAMS parameters
+        '''
+        self._fill_params_dict = _generate_function(_params_dict_source(self._param_keys))
+        self._prior_check = None
+        if len(self._param_keys) <= _UNROLL_MAX_PARAMS:
+            self._prior_check = _generate_function(_prior_check_source(self._lower, self._upper, self._mu,
+                                                                       self._inv_sigma, self._max_half_sq))
+
+    def _setup_prior_arrays(self):
+        '''
+        Store the built-in uniform and gaussian priors as arrays aligned with the params_values 
+        vector passed to get_likelihood_function (one entry per parameter to estimate), so that
+        check_prior_vec never has to look up a parameter name or a prior dictionary:
+        * `_lower`, `_upper` : bounds of each parameter (0 lower bound for 'positive' parameters,
+          infinite otherwise)
+        * `_mu`, `_inv_sigma` : mean and inverse standard deviation of gaussian priors (0 otherwise)
+        * `_max_half_sq` : largest 0.5*((value - mu)/sigma)**2 allowed by the gaussian probability
+          threshold (infinite without a threshold)
+        The normalization of all uniform and gaussian priors is summed into `_prior_lp_const`.
+        Parameters with any other prior are checked with check_prior.
+        '''
+        n_params = len(self.params_to_estimate)
+        self._lower = np.full(n_params, -np.inf)
+        self._upper = np.full(n_params, np.inf)
+        self._mu = np.zeros(n_params)
+        self._inv_sigma = np.zeros(n_params)
+        self._max_half_sq = np.full(n_params, np.inf)
+        self._prior_lp_const = 0.0
+        self._other_priors = []
+        # Subclasses that override check_prior are always checked with their own function
+        vectorized_prior = type(self).check_prior is PIDInterface.check_prior
+        for i, key in enumerate(self.params_to_estimate):
+            if not vectorized_prior or self.prior is None or key not in self.prior:
+                self._other_priors.append((i, key))
+                continue
+            prior = self._prior_cache[key]
+            prior_type = prior[0]
+            if key in self._positive_priors:
+                self._lower[i] = 0.0
             if prior_type == 'uniform':
-                lp += self.uniform_prior(key, value)
+                self._lower[i] = max(self._lower[i], prior[1])
+                self._upper[i] = prior[2]
+                self._prior_lp_const -= math.log(prior[2] - prior[1])
             elif prior_type == 'gaussian':
-                lp += self.gaussian_prior(key, value)
-            elif prior_type == 'exponential':
-                lp += self.exponential_prior(key, value)
-            elif prior_type == 'gamma':
-                lp += self.gamma_prior(key, value)
-            elif prior_type == 'log-uniform':
-                lp += self.log_uniform_prior(key, value)
-            elif prior_type == 'log-gaussian':
-                lp += self.log_gaussian_prior(key, value)
-            elif prior_type == 'beta':
-                lp += self.beta_prior(key, value)
-            elif prior_type == 'log10_isNorm':
-                lp += self.log10_isNorm_prior(key, value)
-            elif prior_type == 'neg_binom':
-                lp += self.neg_binom_prior(key, value)
-            elif prior_type == 'custom':
+                mu, inv_sigma, log_norm, log_threshold = self._gaussian_constants(key)
+                self._mu[i] = mu
+                self._inv_sigma[i] = inv_sigma
+                self._max_half_sq[i] = log_norm - log_threshold
+                self._prior_lp_const += log_norm
+            else:
+                self._other_priors.append((i, key))
+
+    def check_prior_vec(self, params_values):
+        '''
+        Vectorized version of check_prior that takes a NumPy array of parameter values
+        ordered as params_to_estimate instead of a dictionary.
+        Returns the log prior probability or np.inf if params_values is outside the prior support.
+        '''
+        if self._prior_check is not None:
+            lp = self._prior_check(params_values)
+        else:
+            lp = float(self._check_prior_numpy(params_values))
+        if lp == np.inf:
+            return np.inf
+        lp += self._prior_lp_const
+        if self._other_priors:
+            lp += self.check_prior({key: params_values[i] for i, key in self._other_priors})
+        return lp
+
+    def _check_prior_numpy(self, params_values):
+        '''
+        NumPy version of the uniform and gaussian prior checks used by check_prior_vec and
+        check_prior_batch. params_values is a parameter vector or a 2D array with one parameter
+        vector per row, the checks are reduced over the last axis.
+        Returns minus the sum of the gaussian half squared distances or np.inf (per row).
+        '''
+        # Half squared distance of all gaussian priors at once (0 for the other parameters)
+        delta = (params_values - self._mu)*self._inv_sigma
+        half_sq = 0.5*delta*delta
+        invalid = np.any((params_values < self._lower) | (params_values > self._upper) |
+                         (half_sq > self._max_half_sq), axis = -1)
+        return np.where(invalid, np.inf, -np.sum(half_sq, axis = -1))
+
+    def check_prior_batch(self, params_matrix):
+        '''
+        Version of check_prior_vec for a 2D array with one parameter vector per row.
+        Returns an array with the log prior probability of each row (np.inf outside the prior support).
+        '''
+        lp = self._check_prior_numpy(params_matrix) + self._prior_lp_const
+        if self._other_priors:
+            for row in np.flatnonzero(np.isfinite(lp)):
+                lp[row] += self.check_prior({key: params_matrix[row, i] for i, key in self._other_priors})
+        return lp
+
+    def get_likelihood_batch(self, params_matrix):
+        '''
+        Log posterior of a population of parameter vectors, one per row of params_matrix 
+        (ordered as params_to_estimate). Returns an array with one value per row, -np.inf for
+        the rows outside the prior support.
+        The prior is checked for all rows at once and only the rows inside the prior support
+        are simulated. With StochasticInference and n_jobs > 1 the simulations of all rows are
+        sent to the worker processes together. This is the preferred way to evaluate samplers 
+        that propose many parameter vectors per step, for example emcee's EnsembleSampler 
+        with vectorize = True.
+        '''
+        params_matrix = np.atleast_2d(np.asarray(params_matrix, dtype = float))
+        if self.log_space_parameters:
+            params_matrix = np.exp(params_matrix)
+        lp = self.check_prior_batch(params_matrix)
+        ln_prob = np.full(params_matrix.shape[0], -np.inf)
+        feasible = np.isfinite(lp)
+        if np.any(feasible):
+            costs = self._batch_log_likelihood(params_matrix[feasible])
+            ln_prob[feasible] = lp[feasible] + np.asarray(costs, dtype = float)
+        return ln_prob
+
+    def _batch_log_likelihood(self, params_matrix):
+        '''
+        Log-likelihood of each row of params_matrix, evaluated one row at a time.
+        '''
+        return [self._cached_log_likelihood(params_values) for params_values in params_matrix]
+
+    def _log_likelihood(self, params_values):
+        '''
+        Log-likelihood of the parameter values (ordered as params_to_estimate) without the prior.
+        Implemented by the PID interfaces that use get_likelihood_function.
+        '''
+        raise NotImplementedError("_log_likelihood must be implemented in subclasses of PIDInterface "
+                                  "to use get_likelihood_batch")
+
+    def _cached_log_likelihood(self, params_values):
+        '''
+        Returns self._log_likelihood(params_values). If the `cache_decimals` keyword was given, 
+        the results are memoized in a least recently used cache of `cache_size` entries keyed by 
+        the parameter values rounded to `cache_decimals` decimals, so that parameter values 
+        closer than that share the same likelihood.
+        '''
+        if self.cache_decimals is None:
+            return self._log_likelihood(params_values)
+        key = np.round(params_values, self.cache_decimals).tobytes()
+        cache = self._likelihood_cache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        cost = self._log_likelihood(params_values)
+        cache[key] = cost
+        if len(cache) > self.cache_size:
+            cache.popitem(last = False)
+        return cost
+
+    def clear_likelihood_cache(self):
+        '''
+        Empty the likelihood cache, needed whenever the model or the data change.
+        '''
+        self._likelihood_cache.clear()
+
+    def _setup_prior_functions(self):
+        '''
+        Bind the prior function of each parameter in the prior dictionary once, so that
+        check_prior does not have to dispatch on the prior type for every sample.
+        Also validates each prior and stores it as a tuple for the prior functions.
+        '''
+        prior_functions = {'uniform': self.uniform_prior,
+                           'gaussian': self.gaussian_prior,
+                           'exponential': self.exponential_prior,
+                           'gamma': self.gamma_prior,
+                           'log-uniform': self.log_uniform_prior,
+                           'log-gaussian': self.log_gaussian_prior,
+                           'beta': self.beta_prior,
+                           'log10_isNorm': self.log10_isNorm_prior,
+                           'neg_binom': self.neg_binom_prior}
+        self._prior_fns = {}
+        self._positive_priors = set()
+        self._prior_cache = {}
+        if self.prior is None:
+            return
+        for key, prior in self.prior.items():
+            if prior[0] in _PRIOR_LENGTHS and len(prior) < _PRIOR_LENGTHS[prior[0]]:
+                raise ValueError(f'The {prior[0]} prior of param {key} requires {_PRIOR_LENGTHS[prior[0]] - 1} '
+                                 f'arguments, recieved {len(prior) - 1}.')
+            if prior[0] == 'uniform' and prior[2] <= prior[1]:
+                raise ValueError(f'The upper bound of the uniform prior of param {key} must be larger than '
+                                 f'the lower bound, recieved {prior[1]} and {prior[2]}.')
+            if prior[0] in ('gaussian', 'log-gaussian', 'log10_isNorm') and prior[2] <= 0:
+                raise ValueError(f'The standard deviation of the {prior[0]} prior of param {key} must be positive, '
+                                 f'recieved {prior[2]}.')
+            if prior[0] in ('gamma', 'beta') and (prior[1] <= 0 or prior[2] <= 0):
+                raise ValueError(f'The parameters of the {prior[0]} prior of param {key} must be positive, '
+                                 f'recieved {prior[1]} and {prior[2]}.')
+            if prior[0] == 'log-uniform' and (prior[1] <= 0 or prior[2] <= 0):
+                raise ValueError(f'Upper and lower bounds for the log-uniform prior of param {key} must be positive, '
+                                 f'recieved {prior[1]} and {prior[2]}.')
+            self._prior_cache[key] = tuple(prior)
+            if prior[0] == 'custom':
                 # The last element in the prior dictionary must be a callable function
                 # The callable function shoud have the following signature :
                 # Arguments: param_name (str), param_value(float) 
                 # Returns: log prior probability (float or numpy inf)
-                custom_fuction = self.prior[key][-1]
-                lp += custom_fuction(key, value)
+                self._prior_fns[key] = prior[-1]
             else:
-                raise ValueError(f'Prior type undefined: recieved prior {value[0]} for param {key}.')
+                # Undefined prior types are reported when the prior is checked
+                self._prior_fns[key] = prior_functions.get(prior[0])
+            if 'positive' in prior:
+                self._positive_priors.add(key)
+
+    ### This is a function I will edit, implementing sampled arrays should be reasonable
+    def check_prior(self, params_dict):
+        '''
+        To add new prior functions: simply add a new function similar to ones that exist and then 
+        add it to the prior functions in _setup_prior_functions.
+        '''
+        if self.prior is None:
+            raise ValueError('No prior found')
+        lp = 0.0
+        for key,value in params_dict.items():
+            if key in self._positive_priors and value  < 0:
+                return np.inf
+            prior_fn = self._prior_fns[key]
+            if prior_fn is None:
+                raise ValueError(f'Prior type undefined: recieved prior {self.prior[key][0]} for param {key}.')
+            lp += prior_fn(key, value)
+            # Skip the remaining priors once a parameter is outside its prior support
+            if lp == np.inf:
+                return np.inf
         return lp
 
     def uniform_prior(self, param_name, param_value):
@@ -94,71 +390,69 @@ class PIDInterface():
         Returns np.Inf if the param_value is outside the prior range and 0.0 if it is inside. 
         param_name is used to look for the parameter in the prior dictionary.
         '''
-        prior_dict = self.prior
-        if prior_dict is None:
-            raise ValueError('No prior found')
-        lower_bound = prior_dict[param_name][1]
-        upper_bound = prior_dict[param_name][2]
+        prior = self._prior_cache[param_name]
+        lower_bound, upper_bound = prior[1], prior[2]
         if param_value > upper_bound or param_value < lower_bound:
             return np.inf
         else:
-            return np.log( 1/(upper_bound - lower_bound) )
+            return -math.log(upper_bound - lower_bound)
 
     def gaussian_prior(self, param_name, param_value):
         '''
         Check if given param_value is valid according to the prior distribution.
         Returns the log prior probability or np.Inf if the param_value is invalid. 
+        If a probability threshold is given, np.Inf is also returned when the 
+        probability density at param_value falls below that threshold.
         '''
-        prior_dict = self.prior
-        if prior_dict is None:
-            raise ValueError('No prior found')
-        mu = prior_dict[param_name][1]
-        sigma = prior_dict[param_name][2]
-        if sigma < 0:
-            raise ValueError('The standard deviation must be positive.')
-        # Using probability density function for normal distribution
+        mu, inv_sigma, log_norm, log_threshold = self._gaussian_constants(param_name)
+        # Using the log of the probability density function for normal distribution
         # Using scipy.stats.norm has overhead that affects speed up to 2x
-        prob = 1/(np.sqrt(2*np.pi) * sigma) * np.exp(-0.5*(param_value - mu)**2/sigma**2)
-        if prob < 0:
-            warnings.warn('Probability less than 0 while checking Gaussian prior! Current parameter name and value: {0}:{1}.'.format(param_name, param_value))
+        logp = log_norm - 0.5*((param_value - mu)*inv_sigma)**2
+        if logp < log_threshold:
             return np.inf
         else:
-            return np.log(prob)
-        
+            return logp
+
+    def _gaussian_constants(self, param_name):
+        '''
+        Returns (mu, 1/sigma, log normalization, log threshold) of the gaussian prior of 
+        param_name, computed once and stored in self._gaussian_cache.
+        '''
+        if param_name not in self._gaussian_cache:
+            prior = self._prior_cache[param_name]
+            mu, sigma = prior[1], prior[2]
+            # A missing, non-numeric or non-positive threshold means no threshold
+            log_threshold = -math.inf
+            threshold = prior[3] if len(prior) > 3 else None
+            if isinstance(threshold, (int, float, np.number)) and threshold > 0:
+                log_threshold = math.log(threshold)
+            log_norm = -_LOG_2PI_HALF - math.log(sigma)
+            self._gaussian_cache[param_name] = (mu, 1/sigma, log_norm, log_threshold)
+        return self._gaussian_cache[param_name]
+
     def log10_isNorm_prior(self, param_name, param_value):
         '''
         Prior I use frequently where the log value is normally distributed
         Check if given param_value is valid according to the prior distribution.
         Returns the log prior probability or np.Inf if the param_value is invalid. 
         '''
-        prior_dict = self.prior
-        if prior_dict is None:
-            raise ValueError('No prior found')
-        mu = prior_dict[param_name][1]
-        sigma = prior_dict[param_name][2]
-        if sigma < 0:
-            raise ValueError('The standard deviation must be positive.')
-        # Using probability density function for normal distribution
+        prior = self._prior_cache[param_name]
+        mu, sigma = prior[1], prior[2]
+        if param_value <= 0:
+            return np.inf
+        # Using the log of the probability density function for normal distribution
         # Using scipy.stats.norm has overhead that affects speed up to 2x
         ## The normal distribution is imposed on the log of the parameter value
         ## Alternatively, I could establish the parameter as a log value and exponentiate it later
-        prob = 1/(np.sqrt(2*np.pi) * sigma) * np.exp(-0.5*(np.log10(param_value) - mu)**2/sigma**2)
-        if prob < 0:
-            warnings.warn('Probability less than 0 while checking log-is-normal prior! Current parameter name and value: {0}:{1}.'.format(param_name, param_value))
-            return np.inf
-        else:
-            return np.log(prob)
+        return -_LOG_2PI_HALF - math.log(sigma) - 0.5*(math.log10(param_value) - mu)**2/sigma**2
         
     def neg_binom_prior(self, param_name, param_value):
         '''
         Check if given param_value is valid according to the prior distribution.
         Returns the log prior probability or np.inf if the param_value is invalid. 
         '''
-        prior_dict = self.prior
-        if prior_dict is None:
-            raise ValueError('No prior found')
-        alpha = prior_dict[param_name][1]
-        beta = prior_dict[param_name][2]
+        prior = self._prior_cache[param_name]
+        alpha, beta = prior[1], prior[2]
         from scipy.stats import nbinom
         prob = nbinom.pmf(param_value, n=alpha, p=beta/(1+beta))
         if prob < 0:
@@ -172,97 +466,87 @@ class PIDInterface():
         Check if given param_value is valid according to the prior distribution.
         Returns the log prior probability or np.inf if the param_value is invalid. 
         '''
-        prior_dict = self.prior
-        if prior_dict is None:
-            raise ValueError('No prior found')
-        lambda_p = prior_dict[param_name][1]
+        prior = self._prior_cache[param_name]
+        lambda_p = prior[1]
 
-        prob = lambda_p * np.exp(-lambda_p * param_value)
-        if prob < 0:
-            warnings.warn('Probability less than 0 while checking Exponential prior! Current parameter name and value: {0}:{1}.'.format(param_name, param_value))
+        if lambda_p <= 0:
+            warnings.warn('Non-positive rate while checking Exponential prior! Current parameter name and value: {0}:{1}.'.format(param_name, param_value))
             return np.inf
         else:
-            return np.log(prob)
+            # Log of lambda_p * exp(-lambda_p * param_value)
+            return math.log(lambda_p) - lambda_p * param_value
     
     def gamma_prior(self, param_name, param_value):
         '''
         Check if given param_value is valid according to the prior distribution.
         Returns the log prior probability or np.inf if the param_value is invalid. 
         '''
-        prior_dict = self.prior
-        if prior_dict is None:
-            raise ValueError('No prior found')
-        alpha = prior_dict[param_name][1]
-        beta = prior_dict[param_name][2]
-        from scipy.special import gamma
-        prob = (beta**alpha)/gamma(alpha) * param_value**(alpha - 1) * np.exp(-1 * beta*param_value)
-        if prob < 0:
-            warnings.warn('Probability less than 0 while checking Exponential prior! Current parameter name and value: {0}:{1}.'.format(param_name, param_value))
+        prior = self._prior_cache[param_name]
+        alpha, beta = prior[1], prior[2]
+        if param_value < 0:
             return np.inf
-        else:
-            return np.log(prob)
+        # Log of beta**alpha/gamma(alpha) * param_value**(alpha - 1) * exp(-beta*param_value)
+        log_p = alpha*math.log(beta) - math.lgamma(alpha) - beta*param_value
+        if alpha != 1:
+            if param_value == 0:
+                # The density at 0 is infinite for alpha < 1 and 0 for alpha > 1
+                return np.inf if alpha < 1 else -np.inf
+            log_p += (alpha - 1)*math.log(param_value)
+        return log_p
 
     def beta_prior(self, param_name, param_value):
         '''
         Check if given param_value is valid according to the prior distribution.
         Returns the log prior probability or np.inf if the param_value is invalid. 
         '''
-        prior_dict = self.prior
-        if prior_dict is None:
-            raise ValueError('No prior found')
-        alpha = prior_dict[param_name][1]
-        beta = prior_dict[param_name][2]
-        from scipy import special
-        prob = (param_value**(alpha-1) * (1 - param_value)**(beta - 1) )/special.beta(alpha, beta)
-        if prob < 0:
-            warnings.warn('Probability less than 0 while checking Exponential prior! Current parameter name and value: {0}:{1}.'.format(param_name, param_value))
+        prior = self._prior_cache[param_name]
+        alpha, beta = prior[1], prior[2]
+        if param_value < 0 or param_value > 1:
             return np.inf
-        else:
-            return np.log(prob)
+        # Log of param_value**(alpha - 1) * (1 - param_value)**(beta - 1)/B(alpha, beta)
+        log_p = math.lgamma(alpha + beta) - math.lgamma(alpha) - math.lgamma(beta)
+        # The density at 0 (or 1) is infinite for alpha < 1 (beta < 1) and 0 for alpha > 1 (beta > 1)
+        if alpha != 1:
+            if param_value == 0:
+                return np.inf if alpha < 1 else -np.inf
+            log_p += (alpha - 1)*math.log(param_value)
+        if beta != 1:
+            if param_value == 1:
+                return np.inf if beta < 1 else -np.inf
+            log_p += (beta - 1)*math.log1p(-param_value)
+        return log_p
 
     def log_uniform_prior(self, param_name, param_value):
         '''
         Check if given param_value is valid according to the prior distribution.
         Returns the log prior probability or np.inf if the param_value is invalid. 
         '''
-        prior_dict = self.prior
-        if prior_dict is None:
-            raise ValueError('No prior found')
-        lower_bound = prior_dict[param_name][1]
-        upper_bound = prior_dict[param_name][2]
-
-        if lower_bound < 0 or upper_bound < 0:
-            raise ValueError('Upper and lower bounds for log-uniform prior must be positive.')
+        prior = self._prior_cache[param_name]
+        lower_bound, upper_bound = prior[1], prior[2]
 
         if param_value > upper_bound or param_value < lower_bound:
             return np.inf
 
-        prob = 1/(param_value* (np.log(upper_bound) - np.log(lower_bound)))
-        if prob < 0:
+        log_range = math.log(upper_bound) - math.log(lower_bound)
+        if log_range <= 0:
             warnings.warn('Probability less than 0 while checking Log-Uniform prior! Current parameter name and value: {0}:{1}.'.format(param_name, param_value))
             return np.inf
         else:
-            return np.log(prob)
+            # Log of 1/(param_value*log_range)
+            return -math.log(param_value) - math.log(log_range)
 
     def log_gaussian_prior(self, param_name, param_value):
         '''
         Check if given param_value is valid according to the prior distribution.
         Returns the log prior probability or np.inf if the param_value is invalid. 
         '''
-        prior_dict = self.prior
-        if prior_dict is None:
-            raise ValueError('No prior found')
-        mu = prior_dict[param_name][1]
-        sigma = prior_dict[param_name][2]
-        if sigma < 0:
-            raise ValueError('The standard deviation must be positive.')
-        # Using probability density function for log-normal distribution
-        prob = 1/(param_value * np.sqrt(2*np.pi) * sigma) * np.exp((-0.5 * (np.log(param_value) - mu)**2)/sigma**2)
-        if prob < 0:
-            warnings.warn('Probability less than 0 while checking log-normal prior! Current parameter name and value: {0}:{1}.'.format(param_name, param_value))
+        prior = self._prior_cache[param_name]
+        mu, sigma = prior[1], prior[2]
+        if param_value <= 0:
             return np.inf
-        else:
-            return np.log(prob)
+        # Using the log of the probability density function for log-normal distribution
+        log_value = math.log(param_value)
+        return -log_value - _LOG_2PI_HALF - math.log(sigma) - 0.5*(log_value - mu)**2/sigma**2
 
 class InterprelatorInference(PIDInterface):
     def __init__(self, params_to_estimate, M, prior, **kwargs):
@@ -275,18 +559,20 @@ class InterprelatorInference(PIDInterface):
         super().__init__(params_to_estimate, M, prior, **kwargs)
         return
 
-    def setup_likelihood_function(self, data, timepoints, measurements, other_data, other_columns
+    def setup_likelihood_function(self, data, timepoints, measurements, other_data, other_columns,
                                   initial_conditions, parameter_conditions, 
                                   norm_order = 2, **kwargs):
         
         # finds the length of all datapoints
-        N = np.shape(data)[0]
+        data = np.asarray(data)
+        N = data.shape[0]
         
         #Create a data Objects
         # In this case the timepoints should be a list of timepoints vectors for each iteration
         # self.dataDet = BulkData(np.array(timepoints), data, measurements, N)
         self.dataDet = FlowData(data, measurements, N)
         self.dataOther = other_data
+        self.clear_likelihood_cache()
         #If there are multiple initial conditions in a data-set, 
         # should correspond to multiple initial conditions for inference.
         #Note len(initial_conditions) must be equal to the number of trajectories N
@@ -295,7 +581,7 @@ class InterprelatorInference(PIDInterface):
         if self.debug:
             print('The deterministic inference attributes:')
             print('The timepoints shape is {0}'.format(np.shape(timepoints)))
-            print('The data shape is {0}'.format(np.shape(data)))
+            print('The data shape is {0}'.format(data.shape))
             print('The measurmenets is {0}'.format(measurements))
             print('The N is {0}'.format(N))
             print('Using the initial conditions: {0}'.format(initial_conditions))
@@ -314,28 +600,20 @@ class InterprelatorInference(PIDInterface):
         if self.LL_det is None:
             raise RuntimeError("Must call InterprelatorInference.setup_likelihood_function before using InterprelatorInference.get_likelihood_function.")
         #this part is the only part that is called repeatedly
-        params_dict = {}
-        for key, p in zip(self.params_to_estimate, params):
-            if self.log_space_parameters:
-                params_dict[key] = np.exp(p)
-            else:
-                params_dict[key] = p
+        if self.log_space_parameters:
+            params_values = np.exp(params)
+        else:
+            params_values = np.asarray(params, dtype = float)
         
         # Check prior
         # Your prior function will return a float of log-prior
         lp = 0
-        lp = self.check_prior(params_dict)
-        if not np.isfinite(lp):
+        lp = self.check_prior_vec(params_values)
+        if not math.isfinite(lp):
             return -np.inf
         else:
-            # Reset to default
-            self.LL_det.set_init_params(self.default_parameters)
-            # Set new sampler parameter
-            self.LL_det.set_init_params(params_dict)
-            if self.debug:
-                print('current sample:', params_dict)
             #apply cost function
-            LL_det_cost = self.LL_det.py_log_likelihood()
+            LL_det_cost = self._cached_log_likelihood(params_values)
             # if self.debug:
             #     print('current cost:', LL_det_cost)
             ln_prob = lp + LL_det_cost
@@ -343,50 +621,175 @@ class InterprelatorInference(PIDInterface):
                 print('current cost total:', ln_prob)
             #print("params", params, "ln_prob", ln_prob)
             return ln_prob
+
+    def _log_likelihood(self, params_values):
+        # Reuse the same dictionary for every accepted sample
+        params_dict = self._fill_params_dict(params_values, self._params_dict)
+        # Reset to default
+        self.LL_det.set_init_params(self.default_parameters)
+        # Set new sampler parameter
+        self.LL_det.set_init_params(params_dict)
+        if self.debug:
+            print('current sample:', params_dict)
+        return self.LL_det.py_log_likelihood()
         
 
 ########################################################################################################
 # ########## I have copied from below, but I am not using anything from the below function ##############
 # #######################################################################################################
 
+def _build_stochastic_likelihood(M, data, timepoints, measurements, initial_conditions,
+                                 parameter_conditions, norm_order, N_simulations, **kwargs):
+    '''
+    Create the StochasticTrajectories data object and the stochastic likelihood object.
+    '''
+    N = data.shape[0]
+    dataStoch = StochasticTrajectories(np.asarray(timepoints), data, measurements, N)
+    #If there are multiple initial conditions in a data-set,
+    # should correspond to multiple initial conditions for inference.
+    # Note len(initial_conditions) must be equal to the number of trajectories N
+    # Same holds for parameter_conditions
+    if parameter_conditions is not None:
+        LL_stoch = STLL(model = M, init_state = initial_conditions,
+                        init_params = parameter_conditions,
+                        data = dataStoch, N_simulations = N_simulations,
+                        norm_order = norm_order, **kwargs)
+    else:
+        LL_stoch = STLL(model = M, init_state = initial_conditions,
+                        data = dataStoch, N_simulations = N_simulations,
+                        norm_order = norm_order, **kwargs)
+    return dataStoch, LL_stoch
+
+# Likelihood object of a StochasticInference worker process
+_worker_LL_stoch = None
+
+def _init_stochastic_worker(seeds, M, data, timepoints, measurements, initial_conditions,
+                            parameter_conditions, norm_order, kwargs):
+    global _worker_LL_stoch
+    # Forked workers inherit the state of the random number generator, so each one
+    # takes its own seed (drawn in the parent process) from the seeds queue
+    py_seed_random(seeds.get())
+    _, _worker_LL_stoch = _build_stochastic_likelihood(M, data, timepoints, measurements,
+                                                       initial_conditions, parameter_conditions,
+                                                       norm_order, 1, **kwargs)
+
+def _stochastic_worker_log_likelihood(default_parameters, params_dict, N_simulations, norm_order):
+    _worker_LL_stoch.set_likelihood_options(N_simulations = N_simulations, norm_order = norm_order)
+    _worker_LL_stoch.set_init_params(default_parameters)
+    _worker_LL_stoch.set_init_params(params_dict)
+    return _worker_LL_stoch.py_log_likelihood()
+
 # Add a new class similar to this to create new interfaces.
 class StochasticInference(PIDInterface):
     def __init__(self, params_to_estimate, M, prior, **kwargs):
         self.LL_stoch = None
         self.dataStoch = None
+        self._executor = None
+        self._worker_args = None
         if 'debug' in kwargs:
             self.debug = kwargs.get('debug')
         super().__init__(params_to_estimate, M, prior, **kwargs)
         return
 
+    def __getstate__(self):
+        # The worker processes are not copied, a copy starts its own when it needs them
+        state = super().__getstate__()
+        state['_executor'] = None
+        return state
+
     def setup_likelihood_function(self, data, timepoints, measurements,
                                   initial_conditions, parameter_conditions,
-                                  norm_order=2, N_simulations=3,
+                                  norm_order=2, N_simulations=3, n_jobs=1,
                                   **kwargs):
-        N = np.shape(data)[0]
-        self.dataStoch = StochasticTrajectories(np.array(timepoints), data, measurements, N)
+        '''
+        Set up the stochastic likelihood. With n_jobs > 1 (or n_jobs = -1 for all CPUs) the 
+        N_simulations stochastic simulations of each likelihood evaluation are split across a 
+        pool of worker processes. Processes are used instead of threads because the SSA 
+        simulator in bioscrape does not release the GIL. This only pays off when a single 
+        likelihood evaluation is expensive compared to sending the parameters to the workers.
+        '''
+        data = np.asarray(data)
+        N = data.shape[0]
         if self.debug:
             print('Stochastic inference attributes:')
             print('The timepoints shape is {0}'.format(np.shape(timepoints)))
-            print('The data shape is {0}'.format(np.shape(data)))
+            print('The data shape is {0}'.format(data.shape))
             print('The measurmenets is {0}'.format(measurements))
             print('The N is {0}'.format(N))
             print('Using the initial conditions: {0}'.format(initial_conditions))
             print('Using the parameter conditions: {0}'.format(parameter_conditions))
-        #If there are multiple initial conditions in a data-set,
-        # should correspond to multiple initial conditions for inference.
-        # Note len(initial_conditions) must be equal to the number of trajectories N
-        # Same holds for parameter_conditions
-        if parameter_conditions is not None:
-            self.LL_stoch = STLL(model = self.M, init_state = initial_conditions,
-                                init_params = parameter_conditions,
-                                data = self.dataStoch, N_simulations = N_simulations,
-                                norm_order = norm_order, **kwargs)
-        else:
-            self.LL_stoch = STLL(model = self.M, init_state = initial_conditions,
-                                data = self.dataStoch, N_simulations = N_simulations,
-                                norm_order = norm_order, **kwargs)
+        self.clear_likelihood_cache()
+        self.dataStoch, self.LL_stoch = _build_stochastic_likelihood(self.M, data, timepoints,
+                                                                     measurements, initial_conditions,
+                                                                     parameter_conditions, norm_order,
+                                                                     N_simulations, **kwargs)
+        self.close()
+        self._worker_args = None
+        if n_jobs is None or n_jobs < 1:
+            n_jobs = os.cpu_count()
+        n_jobs = min(n_jobs, N_simulations)
+        if n_jobs > 1:
+            self._worker_args = (self.M, data, timepoints, measurements, initial_conditions,
+                                 parameter_conditions, norm_order, kwargs)
+            # Number of simulations run by each worker
+            self._simulations_split = [len(c) for c in np.array_split(np.arange(N_simulations), n_jobs)]
+            self._norm_order = norm_order if norm_order else 1
 
+    def close(self):
+        '''
+        Shut down the worker processes started with n_jobs > 1. They are started again
+        the next time the likelihood is evaluated.
+        '''
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _parallel_log_likelihood(self, params_dict):
+        '''
+        Evaluates the stochastic likelihood with the simulations split across the worker processes.
+        '''
+        return self._combine_simulations(self._submit_simulations(params_dict))
+
+    def _submit_simulations(self, params_dict):
+        '''
+        Submit the simulations for one parameter dictionary to the worker processes.
+        params_dict must not be modified until the returned futures are done.
+        '''
+        if self._executor is None:
+            n_workers = len(self._simulations_split)
+            # The worker seeds are drawn from the bioscrape random number generator, 
+            # so seeding it with py_seed_random also seeds the workers
+            seeds = multiprocessing.Queue()
+            for _ in range(n_workers):
+                seeds.put(py_rand_int() or 1)
+            self._executor = ProcessPoolExecutor(max_workers = n_workers,
+                                                 initializer = _init_stochastic_worker,
+                                                 initargs = (seeds,) + self._worker_args)
+        return [self._executor.submit(_stochastic_worker_log_likelihood, self.default_parameters,
+                                      params_dict, n_sims, self._norm_order)
+                for n_sims in self._simulations_split]
+
+    def _combine_simulations(self, futures):
+        '''
+        The costs of the workers are combined the same way the likelihood combines 
+        individual simulations: -(sum of |error|^norm_order)^(1/norm_order)/N_simulations.
+        '''
+        error = 0.0
+        for future, n_sims in zip(futures, self._simulations_split):
+            cost = future.result()
+            if cost == -np.inf:
+                return -np.inf
+            error += (-cost*n_sims)**self._norm_order
+        return -error**(1./self._norm_order)/sum(self._simulations_split)
+
+    def _batch_log_likelihood(self, params_matrix):
+        if self._worker_args is None or self.cache_decimals is not None:
+            return super()._batch_log_likelihood(params_matrix)
+        # Submit the simulations of all proposals before waiting for any of them,
+        # each proposal needs its own dictionary since they are sent to the workers later
+        futures = [self._submit_simulations(self._fill_params_dict(params_values, {}))
+                   for params_values in params_matrix]
+        return [self._combine_simulations(f) for f in futures]
 
     def get_likelihood_function(self, params):
         # Set params here and return the likelihood object.
@@ -394,29 +797,34 @@ class StochasticInference(PIDInterface):
             raise RuntimeError("Must call StochasticInference.setup_likelihood_function before using StochasticInference.get_likelihood_function.")
 
         #Set params
-        params_dict = {}
-        for key, p in zip(self.params_to_estimate, params):
-            if self.log_space_parameters:
-                params_dict[key] = np.exp(p)
-            else:
-                params_dict[key] = p
+        if self.log_space_parameters:
+            params_values = np.exp(params)
+        else:
+            params_values = np.asarray(params, dtype = float)
 
         #Prior
         lp = 0
-        lp = self.check_prior(params_dict)
-        if not np.isfinite(lp):
+        lp = self.check_prior_vec(params_values)
+        if not math.isfinite(lp):
             return -np.inf
         else:
-            # Reset to default
-            self.LL_stoch.set_init_params(self.default_parameters)
-            self.LL_stoch.set_init_params(params_dict)
-            if self.debug:
-                print('current sample:', params_dict)
-            LL_stoch_cost = self.LL_stoch.py_log_likelihood()
+            LL_stoch_cost = self._cached_log_likelihood(params_values)
             ln_prob = lp + LL_stoch_cost
             if self.debug:
                 print('current cost total:', ln_prob)
             return ln_prob
+
+    def _log_likelihood(self, params_values):
+        # Reuse the same dictionary for every accepted sample
+        params_dict = self._fill_params_dict(params_values, self._params_dict)
+        if self.debug:
+            print('current sample:', params_dict)
+        if self._worker_args is not None:
+            return self._parallel_log_likelihood(params_dict)
+        # Reset to default
+        self.LL_stoch.set_init_params(self.default_parameters)
+        self.LL_stoch.set_init_params(params_dict)
+        return self.LL_stoch.py_log_likelihood()
        
 # Add a new class similar to this to create new interfaces.
 class DeterministicInference(PIDInterface):
@@ -432,23 +840,25 @@ class DeterministicInference(PIDInterface):
     def setup_likelihood_function(self, data, timepoints, measurements,
                                   initial_conditions, parameter_conditions, 
                                   norm_order = 2, **kwargs):
-        N = np.shape(data)[0]
-        #Create a data Objects
-        # In this case the timepoints should be a list of timepoints vectors for each iteration
-        self.dataDet = BulkData(np.array(timepoints), data, measurements, N)
-        #If there are multiple initial conditions in a data-set, 
-        # should correspond to multiple initial conditions for inference.
-        #Note len(initial_conditions) must be equal to the number of trajectories N
-        # Similarly, if parameter_conditions are provided then the length must equal
-        # number of trajectories N
+        data = np.asarray(data)
+        N = data.shape[0]
         if self.debug:
             print('The deterministic inference attributes:')
             print('The timepoints shape is {0}'.format(np.shape(timepoints)))
-            print('The data shape is {0}'.format(np.shape(data)))
+            print('The data shape is {0}'.format(data.shape))
             print('The measurmenets is {0}'.format(measurements))
             print('The N is {0}'.format(N))
             print('Using the initial conditions: {0}'.format(initial_conditions))
             print('Using the parameter conditions: {0}'.format(parameter_conditions))
+        self.clear_likelihood_cache()
+        #Create a data Objects
+        # In this case the timepoints should be a list of timepoints vectors for each iteration
+        self.dataDet = BulkData(np.asarray(timepoints), data, measurements, N)
+        #If there are multiple initial conditions in a data-set, 
+        # should correspond to multiple initial conditions for inference.
+        #Note len(initial_conditions) must be equal to the number of trajectories N
+        # Similarly, if parameter_conditions are provided then the length must equal
+        # number of trajectories N
         #Create Likelihood object
         if parameter_conditions is not None:
             self.LL_det = DLL(model = self.M, init_state = initial_conditions, 
@@ -462,28 +872,20 @@ class DeterministicInference(PIDInterface):
         if self.LL_det is None:
             raise RuntimeError("Must call DeterministicInference.setup_likelihood_function before using DeterministicInference.get_likelihood_function.")
         #this part is the only part that is called repeatedly
-        params_dict = {}
-        for key, p in zip(self.params_to_estimate, params):
-            if self.log_space_parameters:
-                params_dict[key] = np.exp(p)
-            else:
-                params_dict[key] = p
+        if self.log_space_parameters:
+            params_values = np.exp(params)
+        else:
+            params_values = np.asarray(params, dtype = float)
         
         # Check prior
         # Your prior function will return a float of log-prior
         lp = 0
-        lp = self.check_prior(params_dict)
-        if not np.isfinite(lp):
+        lp = self.check_prior_vec(params_values)
+        if not math.isfinite(lp):
             return -np.inf
         else:
-            # Reset to default
-            self.LL_det.set_init_params(self.default_parameters)
-            # Set new sampler parameter
-            self.LL_det.set_init_params(params_dict)
-            if self.debug:
-                print('current sample:', params_dict)
             #apply cost function
-            LL_det_cost = self.LL_det.py_log_likelihood()
+            LL_det_cost = self._cached_log_likelihood(params_values)
             # if self.debug:
             #     print('current cost:', LL_det_cost)
             ln_prob = lp + LL_det_cost
@@ -491,6 +893,17 @@ class DeterministicInference(PIDInterface):
                 print('current cost total:', ln_prob)
             #print("params", params, "ln_prob", ln_prob)
             return ln_prob
+
+    def _log_likelihood(self, params_values):
+        # Reuse the same dictionary for every accepted sample
+        params_dict = self._fill_params_dict(params_values, self._params_dict)
+        # Reset to default
+        self.LL_det.set_init_params(self.default_parameters)
+        # Set new sampler parameter
+        self.LL_det.set_init_params(params_dict)
+        if self.debug:
+            print('current sample:', params_dict)
+        return self.LL_det.py_log_likelihood()
         
 class LMFitInference(PIDInterface):
     
@@ -531,7 +944,7 @@ class LMFitInference(PIDInterface):
             # Check prior
             lp = 0
             lp = self.check_prior(params_values_dict)
-            if not np.isfinite(lp):
+            if not math.isfinite(lp):
                 nans_array = np.array([np.nan]*len(timepoints))
                 return nans_array
             self.M.set_species(initial_conditions)
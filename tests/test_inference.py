@@ -10,9 +10,13 @@ from bioscrape.types import Model
 from bioscrape.simulator import py_simulate_model
 from bioscrape.inference import py_inference
 from bioscrape.inference_setup import InferenceSetup
-from bioscrape.pid_interfaces import PIDInterface
+from bioscrape import pid_interfaces
+from bioscrape.pid_interfaces import PIDInterface, StochasticInference, DeterministicInference
 from emcee import EnsembleSampler
 from lmfit.minimizer import MinimizerResult
+from concurrent.futures import Future
+import pickle
+import copy
 
 np.random.seed(123)
 
@@ -170,6 +174,170 @@ def test_gaussian_priors(model_setup):
     lp = test_pid_interface.check_prior(params_dict)
     np.testing.assert_allclose(lp, log_prior, rtol = 0.1)
 
+def test_gaussian_prior_threshold(model_setup):
+    """ Gaussian prior with a probability threshold
+    """
+    M, params_to_estimate = model_setup
+    prior = {'m' : ['gaussian', 0, 1, 0.01],'b' : ['gaussian', 0, 1, 0.01]}
+    test_pid_interface = PIDInterface(params_to_estimate, M, prior)
+    lp = test_pid_interface.check_prior({'m':1,'b':-1})
+    np.testing.assert_allclose(lp, 2*scipy.stats.norm.logpdf(1))
+    lp = test_pid_interface.check_prior({'m':1,'b':3.5})
+    assert lp == np.inf
+    # A zero or missing threshold means no threshold
+    prior = {'m' : ['gaussian', 0, 1, 0],'b' : ['gaussian', 0, 1, None]}
+    test_pid_interface = PIDInterface(params_to_estimate, M, prior)
+    lp = test_pid_interface.check_prior({'m':1,'b':3.5})
+    np.testing.assert_allclose(lp, scipy.stats.norm.logpdf(1) + scipy.stats.norm.logpdf(3.5))
+
+def test_vectorized_priors(model_setup):
+    """ check_prior_vec must agree with check_prior
+    """
+    M, params_to_estimate = model_setup
+    prior = {'m' : ['uniform', -2, 2],'b' : ['gaussian', 4.2, 1, 0.01]}
+    test_pid_interface = PIDInterface(params_to_estimate, M, prior)
+    for m, b in [(-1, 4), (0.5, 6), (3, 4), (1, 9)]:
+        lp = test_pid_interface.check_prior({'m':m, 'b':b})
+        lp_vec = test_pid_interface.check_prior_vec(np.array([m, b], dtype = float))
+        np.testing.assert_allclose(lp_vec, lp)
+
+def test_batch_priors(model_setup):
+    """ check_prior_batch must agree with check_prior_vec for each row
+    """
+    M, params_to_estimate = model_setup
+    prior = {'m' : ['uniform', -2, 2],'b' : ['gaussian', 4.2, 1, 0.01]}
+    test_pid_interface = PIDInterface(params_to_estimate, M, prior)
+    params_matrix = np.array([[-1, 4], [0.5, 6], [3, 4], [1, 9]], dtype = float)
+    lp_batch = test_pid_interface.check_prior_batch(params_matrix)
+    lp_rows = [test_pid_interface.check_prior_vec(params_values) for params_values in params_matrix]
+    np.testing.assert_allclose(lp_batch, lp_rows)
+
+def test_prior_check_backends(monkeypatch):
+    """ The generated and NumPy prior checks must agree with check_prior
+    """
+    param_names = ['k{0}'.format(i) for i in range(25)]
+    rule = ('assignment', {'equation':'y = ' + ' + '.join(param_names)})
+    M = Model(species = ['y'], parameters = {key:1.0 for key in param_names}, rules = [rule])
+    prior = {}
+    for i, key in enumerate(param_names):
+        if i % 2:
+            prior[key] = ['uniform', -1, 3]
+        else:
+            prior[key] = ['gaussian', 1, 0.5, 0.01]
+    params_matrix = np.random.normal(1, 0.8, size = (50, len(param_names)))
+    for unroll_max_params in [len(param_names), 0]:
+        # The prior check is only generated for up to _UNROLL_MAX_PARAMS parameters
+        monkeypatch.setattr(pid_interfaces, '_UNROLL_MAX_PARAMS', unroll_max_params)
+        test_pid_interface = PIDInterface(param_names, M, prior)
+        assert (test_pid_interface._prior_check is None) == (unroll_max_params == 0)
+        expected = [test_pid_interface.check_prior(dict(zip(param_names, params))) for params in params_matrix]
+        assert np.any(np.isfinite(expected)) and not np.all(np.isfinite(expected))
+        lp = [test_pid_interface.check_prior_vec(params) for params in params_matrix]
+        np.testing.assert_allclose(lp, expected)
+        np.testing.assert_allclose(test_pid_interface.check_prior_batch(params_matrix), expected)
+
+def test_pickle_pid_interface(model_setup):
+    """ The generated functions are regenerated when a PID interface is unpickled or copied
+    """
+    M, params_to_estimate = model_setup
+    prior = {'m' : ['uniform', -2, 2],'b' : ['gaussian', 4.2, 1, 0.01]}
+    test_pid_interface = PIDInterface(params_to_estimate, M, prior)
+    params_values = np.array([-1, 4], dtype = float)
+    lp = test_pid_interface.check_prior_vec(params_values)
+    for copied in [pickle.loads(pickle.dumps(test_pid_interface)), copy.deepcopy(test_pid_interface)]:
+        assert copied.check_prior_vec(params_values) == lp
+        assert copied._fill_params_dict(params_values, {}) == {'m':-1.0, 'b':4.0}
+
+def test_likelihood_batch(model_setup):
+    """ get_likelihood_batch must agree with get_likelihood_function for each row
+    """
+    M, params_to_estimate = model_setup
+    prior = {'m' : ['uniform', -5, 5],'b' : ['gaussian', 4.2, 1, 0.01]}
+    timepoints = np.linspace(0, 10, 20)
+    data = np.reshape(-0.9594*timepoints + 4.294, (1, len(timepoints), 1))
+    # The last two rows are outside the prior support
+    params_matrix = np.array([[-0.9594, 4.294], [-1, 4], [-2, 5], [6, 4], [-1, 9]])
+    for log_space_parameters in [False, True]:
+        test_pid_interface = DeterministicInference(params_to_estimate, M, prior,
+                                                    log_space_parameters = log_space_parameters)
+        test_pid_interface.setup_likelihood_function(data, timepoints, ['y'], {}, None)
+        if log_space_parameters:
+            # Log of the absolute values, the last two rows are still outside the prior support
+            params_matrix = np.log(np.abs(params_matrix))
+        ln_prob = test_pid_interface.get_likelihood_batch(params_matrix)
+        expected = [test_pid_interface.get_likelihood_function(params) for params in params_matrix]
+        np.testing.assert_allclose(ln_prob, expected)
+        assert np.all(ln_prob[-2:] == -np.inf)
+
+def test_likelihood_cache(model_setup):
+    """ Memoized likelihood with cache_decimals
+    """
+    M, params_to_estimate = model_setup
+    prior = {'m' : ['uniform', -5, 5],'b' : ['uniform', -5, 5]}
+    timepoints = np.linspace(0, 10, 20)
+    data = np.reshape(-0.9594*timepoints + 4.294, (1, len(timepoints), 1))
+    test_pid_interface = DeterministicInference(params_to_estimate, M, prior,
+                                                cache_decimals = 3, cache_size = 2)
+    test_pid_interface.setup_likelihood_function(data, timepoints, ['y'], {}, None)
+    calls = []
+    log_likelihood = test_pid_interface._log_likelihood
+    def counted_log_likelihood(params_values):
+        calls.append(params_values)
+        return log_likelihood(params_values)
+    test_pid_interface._log_likelihood = counted_log_likelihood
+    lp = test_pid_interface.get_likelihood_function(np.array([-1, 4]))
+    # Equal after rounding to cache_decimals
+    assert test_pid_interface.get_likelihood_function(np.array([-1.0001, 4])) == lp
+    assert len(calls) == 1
+    # The oldest entry is evicted once cache_size entries are stored
+    test_pid_interface.get_likelihood_function(np.array([-2, 4]))
+    test_pid_interface.get_likelihood_function(np.array([-3, 4]))
+    assert len(calls) == 3
+    test_pid_interface.get_likelihood_function(np.array([-3, 4]))
+    assert len(calls) == 3
+    test_pid_interface.get_likelihood_function(np.array([-1, 4]))
+    assert len(calls) == 4
+    # Setting up the likelihood again clears the cache
+    test_pid_interface.setup_likelihood_function(data, timepoints, ['y'], {}, None)
+    test_pid_interface.get_likelihood_function(np.array([-1, 4]))
+    assert len(calls) == 5
+
+def test_combine_stochastic_simulations(model_setup):
+    """ The costs of the workers must combine to the cost of all simulations together
+    """
+    M, params_to_estimate = model_setup
+    prior = {'m' : ['uniform', -5, 5],'b' : ['uniform', -5, 5]}
+    test_pid_interface = StochasticInference(params_to_estimate, M, prior)
+    # Two workers running 2 and 1 simulations with errors (3, 4) and (12,)
+    test_pid_interface._simulations_split = [2, 1]
+    test_pid_interface._norm_order = 2
+    def done(cost):
+        future = Future()
+        future.set_result(cost)
+        return future
+    cost = test_pid_interface._combine_simulations([done(-5/2), done(-12)])
+    np.testing.assert_allclose(cost, -13/3)
+    cost = test_pid_interface._combine_simulations([done(-5/2), done(-np.inf)])
+    assert cost == -np.inf
+
+def test_parallel_stochastic_inference(model_setup):
+    """ The likelihood with the simulations split across 2 worker processes
+    """
+    M, params_to_estimate = model_setup
+    prior = {'m' : ['uniform', -5, 5],'b' : ['uniform', -5, 5]}
+    timepoints = np.linspace(0, 10, 20)
+    data = np.reshape(-0.9594*timepoints + 4.294, (1, len(timepoints), 1))
+    costs = []
+    for n_jobs in [1, 2]:
+        test_pid_interface = StochasticInference(params_to_estimate, M, prior)
+        test_pid_interface.setup_likelihood_function(data, timepoints, ['y'], {}, None,
+                                                     N_simulations = 4, n_jobs = n_jobs)
+        costs.append([test_pid_interface.get_likelihood_function(np.array(params))
+                      for params in [[-0.9594, 4.294], [-1, 4], [6, 4]]])
+        test_pid_interface.close()
+    np.testing.assert_allclose(costs[1], costs[0])
+    assert costs[1][2] == -np.inf
+
 def test_exponential_priors(model_setup):
     """ Exponential prior testing
     """
@@ -215,6 +383,29 @@ def test_beta_priors(model_setup):
     lp = test_pid_interface.check_prior(params_dict)
     np.testing.assert_allclose(lp, log_prior, rtol = 0.1)
     
+def test_prior_support_boundaries(model_setup):
+    """ Gamma and beta priors at the boundaries of their support
+    """
+    M, params_to_estimate = model_setup
+    prior = {'m' : ['gamma', 1, 4],'b' : ['beta', 1, 1]}
+    test_pid_interface = PIDInterface(params_to_estimate, M, prior)
+    lp = test_pid_interface.check_prior({'m':0,'b':0})
+    np.testing.assert_allclose(lp, scipy.stats.gamma(1, scale = 1/4).logpdf(0) + scipy.stats.beta(1, 1).logpdf(0))
+    lp = test_pid_interface.check_prior({'m':1,'b':1})
+    np.testing.assert_allclose(lp, scipy.stats.gamma(1, scale = 1/4).logpdf(1) + scipy.stats.beta(1, 1).logpdf(1))
+    assert test_pid_interface.check_prior({'m':-1,'b':0.5}) == np.inf
+    assert test_pid_interface.check_prior({'m':1,'b':1.5}) == np.inf
+
+def test_invalid_priors(model_setup):
+    """ Invalid prior parameters are reported when the PID interface is created
+    """
+    M, params_to_estimate = model_setup
+    for invalid_prior in [['uniform', 10, 10], ['gaussian', 0, 0], ['log-gaussian', 0, -1], ['log10_isNorm', 0, 0],
+                          ['gamma', 0, 4], ['beta', 2, -1], ['log-uniform', 0, 10]]:
+        prior = {'m' : invalid_prior,'b' : ['uniform', 0, 10]}
+        with pytest.raises(ValueError):
+            PIDInterface(params_to_estimate, M, prior)
+
 def test_log_uniform_priors(model_setup):
     """ Log-Uniform prior testing
     """